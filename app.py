@@ -1,90 +1,272 @@
 import streamlit as st
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import pandas as pd
+import orjson
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+import hashlib
+import io
+import os
 import re
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+# Combine search terms with OR for broader search
+GEO_SEARCH_TERM = "scRNA-seq OR single-cell RNAseq OR scRNAseq"
+GEO_SUMMARY_URL = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esummary.fcgi"
+NCBI_API_KEY = os.getenv("NCBI_API_KEY")
+NCBI_EMAIL = os.getenv("NCBI_EMAIL", "")
+MAX_REQUESTS_PER_SECOND = 10 if NCBI_API_KEY else 3  # NCBI E-utilities limits with/without an API key
+SUMMARY_FIELDS = ["accession", "title", "summary", "taxon"]  # esummary fields the app uses
+HIDDEN_COLUMNS = ["_summary_lc", "_species_lc"]  # Lowercase copies used for filtering, never displayed
+# Explicit dtypes for the processed table; low-cardinality columns are stored as categoricals
+DATASET_DTYPES = {
+    "GEO Number": "string",
+    "Title": "string",
+    "Species": "category",
+    "Longitudinal Study": "category",
+    "Summary": "string",
+    "_summary_lc": "string",
+    "_species_lc": "category",
+}
+REQUEST_TIMEOUT = (3.05, 30)  # (connect, read) seconds
+CACHE_TTL = 3600  # seconds before cached NCBI results are refetched
+CACHE_DIR = Path(".cache")  # Processed tables persisted across app restarts
+
+@st.cache_resource
+def create_session():
+    """Create a pooled HTTP session that keeps connections to NCBI alive across requests."""
+    session = requests.Session()
+    # E-utilities calls are sent as POST but are read-only, so they are safe to retry
+    retries = Retry(
+        total=3,
+        backoff_factor=0.5,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=Retry.DEFAULT_ALLOWED_METHODS | {"POST"},
+    )
+    session.mount("https://", HTTPAdapter(pool_connections=16, pool_maxsize=16, max_retries=retries))
+    return session
+
+SESSION = create_session()
+
+def with_credentials(params):
+    """Add the NCBI API key and tool identification to E-utilities params when a key is configured."""
+    if NCBI_API_KEY:
+        params.update({"api_key": NCBI_API_KEY, "tool": "ncbi-query-app"})
+        if NCBI_EMAIL:
+            params["email"] = NCBI_EMAIL
+    return params
+
+# Keywords matched against lowercased dataset summaries
+RELEVANT_TERMS = ["single-cell", "scrnaseq", "scrna-seq"]
+LONGITUDINAL_KEYWORDS = ["longitudinal", "time points", "day", "week", "month"]
+
+def keyword_pattern(keywords):
+    """Compile literal keywords into one alternation so a summary is scanned in a single pass."""
+    return re.compile("|".join(map(re.escape, keywords)))
+
+RELEVANT_TERMS_PATTERN = keyword_pattern(RELEVANT_TERMS)
+LONGITUDINAL_PATTERN = keyword_pattern(LONGITUDINAL_KEYWORDS)
 
 # NCBI GEO query functions
-@st.cache_data
+@st.cache_data(ttl=CACHE_TTL, show_spinner=False)
 def search_geo(retmax=10000):
     """Query GEO for datasets matching scRNA-seq-related terms."""
-    # Combine search terms with OR for broader search
-    term = "scRNA-seq OR single-cell RNAseq OR scRNAseq"
-    
     GEO_BASE_URL = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esearch.fcgi"
     params = {
         "db": "gds",
-        "term": term,
+        "term": GEO_SEARCH_TERM,
         "retmax": retmax,
         "retmode": "json",
     }
-    response = requests.get(GEO_BASE_URL, params=params)
+    params = with_credentials(params)
+    # POST keeps the API key out of the URL, which appears in HTTP error messages
+    response = SESSION.post(GEO_BASE_URL, data=params, timeout=REQUEST_TIMEOUT)
     response.raise_for_status()
-    results = response.json()
+    results = orjson.loads(response.content)
     return results.get("esearchresult", {}).get("idlist", []), int(results.get("esearchresult", {}).get("count", 0))
 
-@st.cache_data
-def fetch_geo_metadata(geo_ids, chunk_size=50):
-    """Fetch metadata for given GEO dataset IDs in chunks with error handling."""
-    GEO_SUMMARY_URL = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esummary.fcgi"
+def rate_limiter(max_per_second):
+    """Return a thread-safe callable that blocks to keep calls under max_per_second."""
+    lock = threading.Lock()
+    next_slot = [time.monotonic()]
+
+    def wait():
+        with lock:
+            now = time.monotonic()
+            slot = max(next_slot[0], now)
+            next_slot[0] = slot + 1.0 / max_per_second
+        time.sleep(max(0.0, slot - now))
+
+    return wait
+
+def fetch_summary_chunk(chunk, throttle):
+    """Fetch esummary results for a single chunk of GEO dataset IDs."""
+    params = {
+        "db": "gds",
+        "id": ",".join(chunk),
+        "retmode": "json",
+    }
+    params = with_credentials(params)
+    throttle()
+    # POST keeps long ID lists out of the URL, which GET would overflow at large chunk sizes
+    response = SESSION.post(GEO_SUMMARY_URL, data=params, timeout=REQUEST_TIMEOUT)
+    response.raise_for_status()
+    result = orjson.loads(response.content).get("result", {})
+    # Keep only the fields used downstream so full esummary records don't accumulate across chunks
+    return {
+        uid: {field: record[field] for field in SUMMARY_FIELDS if field in record}
+        for uid, record in result.items()
+        if uid != "uids"
+    }
+
+@st.cache_resource
+def request_throttle():
+    """Return the process-wide rate limiter shared by all concurrent esummary fetches."""
+    return rate_limiter(MAX_REQUESTS_PER_SECOND)
+
+# Expires with the other caches so stored records are refetched after CACHE_TTL
+@st.cache_resource(ttl=CACHE_TTL)
+def metadata_store():
+    """Return the process-wide store of fetched GEO metadata records keyed by ID."""
+    return {}
+
+def fetch_geo_metadata(geo_ids, chunk_size=500):
+    """Fetch metadata for given GEO dataset IDs in concurrent chunks, collecting per-chunk errors."""
+    chunks = [geo_ids[i:i + chunk_size] for i in range(0, len(geo_ids), chunk_size)]
+    throttle = request_throttle()  # Shared across workers and overlapping runs to avoid rate limits
     results = {}
-    for i in range(0, len(geo_ids), chunk_size):
-        chunk = geo_ids[i:i + chunk_size]
-        params = {
-            "db": "gds",
-            "id": ",".join(chunk),
-            "retmode": "json",
-        }
-        try:
-            response = requests.get(GEO_SUMMARY_URL, params=params)
-            response.raise_for_status()
-            chunk_results = response.json().get("result", {})
-            results.update(chunk_results)
-        except requests.exceptions.HTTPError as e:
-            st.error(f"HTTPError: {e} for chunk {chunk}")
-            continue  # Skip the problematic chunk
-        except Exception as e:
-            st.error(f"Unexpected error: {e} for chunk {chunk}")
-            continue
-        time.sleep(0.5)  # Delay to avoid rate limits
-    return results
-
-@st.cache_data
+    errors = []
+    with ThreadPoolExecutor(max_workers=MAX_REQUESTS_PER_SECOND) as executor:
+        futures = [executor.submit(fetch_summary_chunk, chunk, throttle) for chunk in chunks]
+        # Errors are returned rather than displayed so this can run in a background cache refresh
+        for chunk, future in zip(chunks, futures):
+            try:
+                results.update(future.result())
+            except requests.exceptions.HTTPError as e:
+                errors.append(f"HTTPError: {e} for chunk {chunk}")
+                continue  # Skip the problematic chunk
+            except Exception as e:
+                errors.append(f"Unexpected error: {e} for chunk {chunk}")
+                continue
+    return results, errors
+
 def process_geo_metadata(geo_metadata):
     """Process GEO metadata to extract relevant dataset information."""
-    datasets = []
-    for key, value in geo_metadata.items():
-        if key == "uids":
-            continue
-        title = value.get("title", "N/A")
-        summary = value.get("summary", "N/A")
-
-        # Extract GEO Accession Number
-        geo_number = value.get("accession", "N/A")
-        
-        # Extract species and clean formatting
-        species = "Unknown"
-        species_list = value.get("taxon", [])
-        if species_list:
-            species = " ".join("".join(species_list).split())  # Properly format species
-
-        # Include datasets based on relevant terms
-        if not any(term in summary.lower() for term in ["single-cell", "scrnaseq", "scrna-seq"]):
-            continue
-
-        # Check if study is longitudinal
-        longitudinal = "No"
-        if any(keyword in summary.lower() for keyword in ["longitudinal", "time points", "day", "week", "month"]):
-            longitudinal = "Yes"
-
-        datasets.append({
-            "GEO Number": geo_number,
-            "Title": title,
-            "Species": species,
-            "Longitudinal Study": longitudinal,
-            "Summary": summary,
-        })
-    return pd.DataFrame(datasets)
+    records = [value for key, value in geo_metadata.items() if key != "uids"]
+    # Object dtype keeps .str usable when a field is missing from every record (e.g. all-error batches)
+    raw = pd.DataFrame.from_records(records, columns=SUMMARY_FIELDS).astype(object)
+    raw["summary"] = raw["summary"].fillna("N/A")
+    summary_lower = raw["summary"].str.lower()
+
+    # Cheap literal gate first so only candidate datasets reach the regex and column work
+    candidates = (
+        summary_lower.str.contains("single-cell", regex=False)
+        | summary_lower.str.contains("scrna", regex=False)
+    )
+    raw, summary_lower = raw.loc[candidates], summary_lower.loc[candidates]
+
+    # Include datasets based on relevant terms
+    relevant = summary_lower.str.contains(RELEVANT_TERMS_PATTERN)
+    raw, summary_lower = raw.loc[relevant], summary_lower.loc[relevant]
+
+    title = raw["title"].fillna("N/A")
+
+    # Extract GEO Accession Number
+    geo_number = raw["accession"].fillna("N/A")
+
+    # Extract species and clean formatting
+    taxon = raw["taxon"].fillna("")
+    species = taxon.str.join("").str.split().str.join(" ")  # Properly format species
+    species = species.mask(taxon.str.len() == 0, "Unknown")
+
+    # Check if study is longitudinal
+    longitudinal = summary_lower.str.contains(LONGITUDINAL_PATTERN).map({True: "Yes", False: "No"})
+
+    datasets = pd.DataFrame({
+        "GEO Number": geo_number,
+        "Title": title,
+        "Species": species,
+        "Longitudinal Study": longitudinal,
+        "Summary": raw["summary"],
+        "_summary_lc": summary_lower,
+        "_species_lc": species.str.lower(),
+    }).astype(DATASET_DTYPES)
+    return datasets.reset_index(drop=True)
+
+def dataset_cache_path(retmax):
+    """Return the parquet file that persists the processed table for a query."""
+    cache_key = hashlib.md5(f"{GEO_SEARCH_TERM}|{retmax}".encode()).hexdigest()
+    return CACHE_DIR / f"{cache_key}.parquet"
+
+def load_cached_datasets(path):
+    """Load a persisted table and its query counts if the file is younger than CACHE_TTL."""
+    try:
+        if time.time() - path.stat().st_mtime >= CACHE_TTL:
+            return None
+        table = pq.read_table(path)
+        counts = orjson.loads((table.schema.metadata or {})[b"ncbi_query"])
+        total_count, fetched_count = counts["total_count"], counts["fetched_count"]
+    except (OSError, KeyError, TypeError, pa.ArrowException, orjson.JSONDecodeError):
+        return None  # Missing, unreadable or foreign file: fall back to NCBI
+    return table.to_pandas(), total_count, fetched_count, []
+
+def save_cached_datasets(path, data, total_count, fetched_count):
+    """Persist a processed table with its query counts as zstd-compressed parquet."""
+    table = pa.Table.from_pandas(data, preserve_index=False)
+    counts = orjson.dumps({"total_count": total_count, "fetched_count": fetched_count})
+    table = table.replace_schema_metadata({**table.schema.metadata, b"ncbi_query": counts})
+    # Write to a temporary file first so concurrent readers never see a partial parquet file
+    temp_path = path.with_name(f"{path.stem}.{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        CACHE_DIR.mkdir(exist_ok=True)
+        pq.write_table(table, temp_path, compression="zstd")
+        os.replace(temp_path, path)
+    except OSError:
+        temp_path.unlink(missing_ok=True)  # Disk persistence is best-effort; the in-memory cache still applies
+
+# Serve stale results immediately after the TTL and refresh them in the background
+@st.cache_data(ttl=CACHE_TTL, show_spinner=False, refresh_mode="background")
+def fetch_and_process(retmax):
+    """Search GEO, fetch metadata and process it into the dataset table in one cached step."""
+    cache_path = dataset_cache_path(retmax)
+    cached = load_cached_datasets(cache_path)
+    if cached is not None:
+        return cached
+
+    geo_ids, total_count = search_geo(retmax=retmax)
+    if not geo_ids:
+        return None, total_count, 0, []
+    geo_ids = list(dict.fromkeys(geo_ids))  # Drop duplicate IDs, keeping search order
+
+    # Only fetch IDs not already stored by an earlier query
+    store = metadata_store()
+    new_ids = [geo_id for geo_id in geo_ids if geo_id not in store]
+    errors = []
+    if new_ids:
+        new_metadata, errors = fetch_geo_metadata(new_ids)
+        store.update(new_metadata)
+    geo_metadata = {geo_id: store[geo_id] for geo_id in geo_ids if geo_id in store}
+    data = process_geo_metadata(geo_metadata)
+    if not errors:  # Don't persist a table with missing chunks
+        save_cached_datasets(cache_path, data, total_count, len(geo_ids))
+    return data, total_count, len(geo_ids), errors
+
+def hash_dataframe(dataframe):
+    """Hash a DataFrame's columns and row values with pandas' vectorized hashing."""
+    return tuple(dataframe.columns), pd.util.hash_pandas_object(dataframe).values.tobytes()
+
+@st.cache_data(show_spinner=False, hash_funcs={pd.DataFrame: hash_dataframe})
+def convert_df_to_csv(dataframe):
+    """Serialize a DataFrame to CSV bytes using Arrow's C++ CSV writer."""
+    buffer = io.BytesIO()
+    pa_csv.write_csv(pa.Table.from_pandas(dataframe, preserve_index=False), buffer)
+    return buffer.getvalue()
 
 # Initialize session state for filters
 if "data" not in st.session_state:
@@ -107,22 +289,30 @@ This app queries the NCBI GEO database for single-cell RNA-seq datasets using th
 
 # Sidebar inputs for result limits
 retmax = st.sidebar.number_input("Number of Results to Fetch", min_value=10, max_value=10000, value=1000, step=10)
+if NCBI_API_KEY:
+    st.sidebar.caption(f"Using NCBI API key: up to {MAX_REQUESTS_PER_SECOND} requests/second.")
+else:
+    st.sidebar.caption(
+        f"No NCBI API key set: limited to {MAX_REQUESTS_PER_SECOND} requests/second. "
+        "Set the `NCBI_API_KEY` (and optionally `NCBI_EMAIL`) environment variable to raise this to 10."
+    )
 
 # Fetch and display data
 if st.button("Fetch Datasets"):
     with st.spinner("Querying NCBI GEO..."):
-        geo_ids, total_count = search_geo(retmax=retmax)
-        st.info(f"Found {total_count} datasets in total. Displaying up to {len(geo_ids)} datasets.")
-        if not geo_ids:
-            st.warning("No datasets found for the given query.")
+        data, total_count, fetched_count, errors = fetch_and_process(retmax)
+    for error in errors:
+        st.error(error)
+    st.info(f"Found {total_count} datasets in total. Displaying up to {fetched_count} datasets.")
+    if data is None:
+        st.warning("No datasets found for the given query.")
+    else:
+        st.session_state["data"] = data
+
+        if st.session_state["data"].empty:
+            st.warning("No datasets could be processed.")
         else:
-            geo_metadata = fetch_geo_metadata(geo_ids)
-            st.session_state["data"] = process_geo_metadata(geo_metadata)
-            
-            if st.session_state["data"].empty:
-                st.warning("No datasets could be processed.")
-            else:
-                st.success(f"Processed {len(st.session_state['data'])} datasets.")
+            st.success(f"Processed {len(st.session_state['data'])} datasets.")
 
 # Filters for the dataset table
 if st.session_state["data"] is not None:
@@ -140,23 +330,23 @@ if st.session_state["data"] is not None:
     )
 
     # Apply filters
-    df = st.session_state["data"].copy()
+    # Terms are matched literally against the precomputed lowercase columns
+    df = st.session_state["data"]
     if st.session_state["search_filter"]:
-        df = df[df["Summary"].str.contains(st.session_state["search_filter"], case=False, na=False)]
+        search_term = st.session_state["search_filter"].lower()
+        df = df[df["_summary_lc"].str.contains(search_term, regex=False, na=False)]
     if st.session_state["species_filter"]:
-        df = df[df["Species"].str.contains(st.session_state["species_filter"], case=False, na=False)]
+        species_term = st.session_state["species_filter"].lower()
+        df = df[df["_species_lc"].str.contains(species_term, regex=False, na=False)]
     if st.session_state["longitudinal_filter"] != "All":
         df = df[df["Longitudinal Study"] == st.session_state["longitudinal_filter"]]
+    df = df.drop(columns=HIDDEN_COLUMNS)
 
     # Display the table
     st.write(f"### Filtered Datasets ({len(df)} results):")
     st.dataframe(df)
 
     # Option to download the filtered table
-    @st.cache_data
-    def convert_df_to_csv(dataframe):
-        return dataframe.to_csv(index=False).encode('utf-8')
-
     csv = convert_df_to_csv(df)
     st.download_button(
         label="Download Filtered Table as CSV",